@@ -1,23 +1,31 @@
 from utils.caption_agent import generate_instagram_caption
-from utils.post_instagram import post_to_instagram
+from utils.post_instagram import post_to_instagram, post_to_instagram_accounts
 
 
 
 # ========================================
 # 事業内容、写真リスト、タイトル、内容方針、(テンプレートリスト)→インスタに自動投稿
 # ========================================
-def auto_post_instagram(user_input, image_paths, templates_json):
-    """事業内容、写真リスト、タイトル、内容方針→インスタに自動投稿"""
-    # キャプション生成
+def auto_post_instagram(user_input, image_paths, templates_json, *, deep_rag=False, account_names=None):
+    """
+    事業内容、写真リスト、タイトル、内容方針→インスタに自動投稿
+    account_names を指定すると登録済みの複数アカウントへ並行投稿する。
+    Returns {"final_caption", "post"}（worker.py からも呼ばれる）
+    """
+    # キャプション生成（ステージごとのモデルは utils/model_router.py の設定）
     result = generate_instagram_caption(
             user_input,
             templates_json,
-            model="gpt-4.1-mini",
+            deep_rag=deep_rag,
         ) 
 
     final_caption = result["final_caption"]
 
     # インスタ投稿
-    post_to_instagram(image_paths, final_caption)
+    if account_names:
+        post_result = post_to_instagram_accounts(image_paths, final_caption, account_names)
+    else:
+        post_result = post_to_instagram(image_paths, final_caption)
 
-    print(f"投稿完了:{final_caption}")
\ No newline at end of file
+    print(f"投稿完了:{final_caption}")
+    return {"final_caption": final_caption, "post": post_result}
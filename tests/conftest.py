@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# モジュール import 時に必須の環境変数（実 API は呼ばない）
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("SERPER_API_KEY", "test-key")
@@ -0,0 +1,78 @@
+"""
+Plan Cache: 似ているが別の投稿（地名・店舗名・数字違い）には過去のプランを使わない。
+"""
+
+from utils.plan_cache import PlanCache
+
+TEMPLATE = "お知らせ"
+DIRECTION = "Warm tone, highlight what makes it special"
+
+
+def _user_input(title, **extra):
+    return {"business_type": "travel agency", "title": title, "direction": DIRECTION, **extra}
+
+
+def _plan(place):
+    return {
+        "caption_plan": {"hook": f"Discover {place} with your family"},
+        "query": [f"best {place} temples for families", f"{place} garden guided tour"],
+    }
+
+
+def _cache():
+    return PlanCache(path=None)
+
+
+def test_refuses_plan_when_key_entity_differs():
+    cache = _cache()
+    cache.store(_user_input("Private guided tour of Kyoto temples and gardens for families"), TEMPLATE, _plan("Kyoto"))
+
+    assert cache.lookup(_user_input("Private guided tour of Nara temples and gardens for families"), TEMPLATE) is None
+
+    cache.store(_user_input("Grand opening of our brand new Shibuya flagship store"), TEMPLATE, _plan("Shibuya"))
+    assert cache.lookup(_user_input("Grand opening of our brand new Shinjuku flagship store"), TEMPLATE) is None
+
+
+def test_refuses_plan_when_japanese_place_differs():
+    cache = _cache()
+    cache.store(_user_input("京都のお寺と庭園をめぐる家族向けプライベートツアー"), TEMPLATE, _plan("京都"))
+
+    assert cache.lookup(_user_input("奈良のお寺と庭園をめぐる家族向けプライベートツアー"), TEMPLATE) is None
+
+
+def test_refuses_plan_when_numbers_differ():
+    cache = _cache()
+    cache.store(_user_input("Spring sale 10% off"), TEMPLATE, _plan("Kyoto"))
+
+    assert cache.lookup(_user_input("Spring sale 30% off"), TEMPLATE) is None
+
+
+def test_reuses_plan_for_minor_wording_change():
+    cache = _cache()
+    cache.store(_user_input("Private guided tour of Kyoto temples and gardens for families"), TEMPLATE, _plan("Kyoto"))
+
+    hit = cache.lookup(_user_input("Private guided tours of Kyoto temples and gardens for families!"), TEMPLATE)
+
+    assert hit is not None
+    planner_output, similarity = hit
+    assert similarity >= cache.threshold
+    assert planner_output["query"] == _plan("Kyoto")["query"]
+
+
+def test_extra_user_input_fields_are_part_of_the_key():
+    cache = _cache()
+    cache.store(_user_input("Kyoto temple tour", price="10000 yen"), TEMPLATE, _plan("Kyoto"))
+
+    assert cache.lookup(_user_input("Kyoto temple tour", price="20000 yen"), TEMPLATE) is None
+    assert cache.lookup(_user_input("Kyoto temple tour", price="10000 yen"), TEMPLATE) is not None
+
+
+def test_corrupt_cache_file_starts_empty(tmp_path):
+    path = tmp_path / "plan_cache.json"
+    path.write_text('{"bucket": {"truncated', encoding="utf-8")
+
+    cache = PlanCache(path=str(path))
+
+    assert cache.lookup(_user_input("Kyoto temple tour"), TEMPLATE) is None
+    cache.store(_user_input("Kyoto temple tour"), TEMPLATE, _plan("Kyoto"))
+    assert PlanCache(path=str(path)).lookup(_user_input("Kyoto temple tour"), TEMPLATE) is not None
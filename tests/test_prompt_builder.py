@@ -0,0 +1,99 @@
+"""
+Prefix stability of the stage prompts (provider-side prompt caching).
+
+テンプレートのキー順・カテゴリ順が違っても system prompt と prompt_cache_key が
+バイト単位で一致し、可変の user payload は最後のメッセージにだけ入ることを確認する。
+"""
+
+import json
+import os
+
+import pytest
+
+from utils import caption_agent
+from utils.llm import build_messages
+
+TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), "..", "utils", "template_example.json")
+
+
+def _load_templates():
+    with open(TEMPLATES_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _reverse_keys(value):
+    """dict のキー順だけを再帰的に逆にする（list の順序は意味があるので保持）"""
+    if isinstance(value, dict):
+        return {k: _reverse_keys(value[k]) for k in reversed(list(value))}
+    if isinstance(value, list):
+        return [_reverse_keys(v) for v in value]
+    return value
+
+
+def _shuffled(templates):
+    shuffled = _reverse_keys(templates)
+    shuffled["categories"] = list(reversed(shuffled["categories"]))
+    return shuffled
+
+
+@pytest.fixture
+def captured_calls(monkeypatch):
+    calls = []
+
+    def fake_run_stage(stage_name, call, route=None, **kwargs):
+        calls.append({**kwargs, "stage": stage_name})
+        return "caption" if stage_name == "caption_writer" else {"selected_template": "x", "caption_plan": "p", "query": []}
+
+    monkeypatch.setattr(caption_agent.model_router, "run_stage", fake_run_stage)
+    return calls
+
+
+def _run_all_stages(templates, user_input, rag_results):
+    name = sorted(c["name"] for c in templates["categories"])[0]
+
+    caption_agent.run_template_selector(user_input, templates)
+    caption_agent.run_caption_planner(user_input, name, templates)
+    caption_agent.run_caption_writer(
+        user_input,
+        name,
+        templates,
+        {"caption_plan": f"plan for {user_input['title']}"},
+        rag_results,
+    )
+
+
+def test_stage_prefixes_are_byte_stable(captured_calls):
+    templates = _load_templates()
+    assert len(templates["categories"]) > 1
+
+    first_input = {"business_type": "travel_agency", "title": "Kyoto private tour", "direction": "story"}
+    second_input = {"business_type": "cafe", "title": "Matcha latte", "direction": "product"}
+
+    _run_all_stages(templates, first_input, [{"query": "kyoto", "results": []}])
+    _run_all_stages(_shuffled(templates), second_input, [{"query": "matcha", "results": []}])
+
+    assert len(captured_calls) == 6
+    first, second = captured_calls[:3], captured_calls[3:]
+
+    for a, b in zip(first, second):
+        assert a["stage"] == b["stage"]
+        system_a = a["history"][0]["content"]
+        system_b = b["history"][0]["content"]
+        assert system_a.encode("utf-8") == system_b.encode("utf-8"), a["stage"]
+        assert a["prompt_cache_key"] == b["prompt_cache_key"]
+        assert a["prompt_cache_key"].startswith(f"{a['stage']}:")
+
+
+def test_variable_payload_only_in_last_message(captured_calls):
+    templates = _load_templates()
+    user_input = {"business_type": "bakery", "title": "UNIQUE-TITLE-123", "direction": "UNIQUE-DIRECTION-456"}
+
+    _run_all_stages(templates, user_input, [{"query": "UNIQUE-QUERY-789", "results": []}])
+
+    for call in captured_calls:
+        messages = build_messages(call["prompt"], call["history"])
+        assert messages[-1]["role"] == "user"
+        for marker in ("UNIQUE-TITLE-123", "UNIQUE-DIRECTION-456"):
+            assert marker in messages[-1]["content"], call["stage"]
+            for earlier in messages[:-1]:
+                assert marker not in earlier["content"], call["stage"]
@@ -1,9 +1,12 @@
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from utils.llm import run_gpt_json, run_gpt 
 import os
 import requests
 from dotenv import load_dotenv
+from utils import http_client, model_router, rag_retrieval
+from utils.plan_cache import plan_cache
+from utils.prompt_builder import build_system_prompt, prompt_cache_key, sorted_categories
 
 load_dotenv()
 
@@ -29,14 +32,14 @@ Choose the best category using:
 4. business_type only filters out unnatural choices
 
 ### Output JSON ONLY:
-{{
+{
   "selected_template": "<template_name>"
-}}
-
-### TEMPLATES
-{TEMPLATES}
+}
 """
 
+# run_gpt_json の出力検証用スキーマ（フィールド → 型）
+TEMPLATE_SELECTOR_SCHEMA = {"selected_template": str}
+
 
 
 
@@ -79,6 +82,8 @@ def filter_templates(templates_json: Dict[str, Any], required_keys: List[str]) -
 def run_template_selector(
     user_input: Dict[str, Any],
     templates_json: Dict[str, Any],
+    *,
+    route: Optional[Dict[str, Any]] = None,
 ):
     """
     module to get caption plan from template and user input.
@@ -93,15 +98,24 @@ def run_template_selector(
         required_keys=["name", "caption_structure"]
     )
 
-    system_prompt = template_selector_prompt.format(
-        TEMPLATES=json.dumps(extracted_templates, ensure_ascii=False, indent=2)
+    extracted_templates["categories"] = sorted_categories(extracted_templates["categories"])
+
+    # 静的部分（指示文＋テンプレ一覧）を先頭に固定し、プロンプトキャッシュを効かせる
+    system_prompt = build_system_prompt(
+        template_selector_prompt,
+        [("TEMPLATES", extracted_templates)],
     )
 
     # history= に system prompt を最初のメッセージとして渡す
-    return run_gpt_json(
+    return model_router.run_stage(
+        "template_selector",
+        run_gpt_json,
+        route,
         prompt=json.dumps(user_input, ensure_ascii=False),
         history=[{"role": "system", "content": system_prompt}],
-        max_completion_tokens=1024,
+        prompt_cache_key=prompt_cache_key("template_selector", system_prompt),
+        schema=TEMPLATE_SELECTOR_SCHEMA,
+        stage="template_selector",
     )
 
 
@@ -145,15 +159,14 @@ Generate:
 
 Return ONLY one JSON object:
 
-{{
+{
   "caption_plan": "<plan customized for the user>",
   "query": ["<query1>", "<query2>", "..."]
-}}
-
-### Template Provided
-{TEMPLATE}
+}
 """
 
+CAPTION_PLANNER_SCHEMA = {"caption_plan": (str, list, dict), "query": list}
+
 
 
 
@@ -162,6 +175,8 @@ def run_caption_planner(
     user_input: Dict[str, Any],
     selected_template: str,
     templates_json: Dict[str, Any],
+    *,
+    route: Optional[Dict[str, Any]] = None,
 ):
     """
     Caption Planner:
@@ -185,8 +200,9 @@ def run_caption_planner(
         raise ValueError(f"Template not found: {selected_template}")
 
     # --- 2. Caption Planner 用プロンプト作成 ---
-    system_prompt = caption_planner_prompt.format(
-        TEMPLATE=json.dumps(target, ensure_ascii=False, indent=2)
+    system_prompt = build_system_prompt(
+        caption_planner_prompt,
+        [("Template Provided", target)],
     )
 
     # --- 3. GPT に渡す最終 user payload ---
@@ -196,10 +212,15 @@ def run_caption_planner(
     }
 
     # --- 4. GPT 実行 ---
-    return run_gpt_json(
+    return model_router.run_stage(
+        "caption_planner",
+        run_gpt_json,
+        route,
         prompt=json.dumps(payload, ensure_ascii=False),
         history=[{"role": "system", "content": system_prompt}],
-        max_completion_tokens=1024,
+        prompt_cache_key=prompt_cache_key("caption_planner", system_prompt),
+        schema=CAPTION_PLANNER_SCHEMA,
+        stage="caption_planner",
     )
 
 
@@ -219,12 +240,29 @@ SERPER_HEADERS = {
     "Content-Type": "application/json"
 }
 
+# 同じクエリ（Plan Cache で再利用された query など）は Serper を呼ばずに返す
+SERPER_CACHE_TTL = 6 * 60 * 60
+serper_cache = rag_retrieval.PageCache(max_entries=512, ttl=SERPER_CACHE_TTL)
 
-def web_rag_search(queries: List[str], *, num_results: int = 3) -> List[Dict[str, Any]]:
+
+def web_rag_search(
+    queries: List[str],
+    *,
+    num_results: int = 3,
+    hedge_after: Optional[float] = None,
+    deep: bool = False,
+    top_k: int = rag_retrieval.DEFAULT_TOP_K,
+    token_budget: int = rag_retrieval.DEFAULT_TOKEN_BUDGET,
+) -> List[Dict[str, Any]]:
     """
     RAG用のWeb検索。
     - queries: Caption Planner が生成した query のリスト
     - Serper API による Google検索
+    - hedge_after: 指定すると、その秒数で応答がなければヘッジリクエストを投げる
+    - deep: True なら link 先ページ本文を取得し、BM25 で選んだ上位パッセージを
+      各クエリの "passages" に入れる（top_k 件・全クエリ合計 token_budget 以内）
+
+    1件のクエリが失敗しても投稿全体は止めず、そのクエリの results を空にする。
     """
 
     rag_results = []
@@ -232,22 +270,56 @@ def web_rag_search(queries: List[str], *, num_results: int = 3) -> List[Dict[str
     for q in queries:
         payload = {"q": q, "num": num_results}
 
-        response = requests.post(SERPER_URL, headers=SERPER_HEADERS, json=payload)
-        data = response.json()
+        cache_key = f"{num_results}|{q}"
+        cached = serper_cache.get(cache_key)
+        if cached is not None:
+            rag_results.append({"query": q, "results": [dict(r) for r in cached]})
+            continue
+
+        try:
+            if hedge_after is not None:
+                response = http_client.hedged_request(
+                    "POST", SERPER_URL, hedge_after=hedge_after, headers=SERPER_HEADERS, json=payload
+                )
+            else:
+                response = http_client.post(SERPER_URL, headers=SERPER_HEADERS, json=payload)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, http_client.CircuitOpenError, ValueError) as exc:
+            print(f"WARN: Serper search failed for query {q!r}: {exc}")
+            data = None
 
         extracted = []
-        for item in data.get("organic", []):
+        for item in (data or {}).get("organic", []):
             extracted.append({
                 "title": item.get("title", ""),
                 "snippet": item.get("snippet", ""),
                 "link": item.get("link", "")
             })
 
+        # 失敗したクエリはキャッシュしない
+        if data is not None:
+            serper_cache.set(cache_key, [dict(r) for r in extracted])
+
         rag_results.append({
             "query": q,
             "results": extracted
         })
 
+    if deep and rag_results:
+        # 全クエリの link をまとめて並列取得し、その結果を各クエリのランキングに使う
+        pages = rag_retrieval.fetch_pages([r["link"] for item in rag_results for r in item["results"]])
+
+        per_query_budget = token_budget // len(rag_results)
+        for item in rag_results:
+            item["passages"] = rag_retrieval.deep_retrieve(
+                item["query"],
+                item["results"],
+                top_k=top_k,
+                token_budget=per_query_budget,
+                pages=pages,
+            )
+
     return rag_results
 
 
@@ -270,7 +342,7 @@ Generate a final Instagram caption based on:
 - title: post title or main topic
 - direction: intent of the post (what to emphasize)
 - caption_plan: structural plan you MUST roughly follow
-- rag_results: list of objects { "query": "...", "context": "..." }
+- rag_results: list of objects { "query": "...", "results": [{ "title", "snippet", "link" }], "passages": [{ "text", ... }] (optional) }
 
 ### How to write
 
@@ -279,8 +351,9 @@ Generate a final Instagram caption based on:
    - You don't have to label sections; just write a natural caption
 
 2. Use rag_results as factual/context information
-   - Read each { query, context }
+   - Read each query with its snippets and passages (the context)
    - Use context to enrich the caption with concrete details
+   - Prefer passages when present; they contain the most relevant page content
    - Do NOT copy context verbatim; rewrite naturally in English
    - If some queries have no useful context, just ignore them
 
@@ -316,6 +389,8 @@ def run_caption_writer(
     templates_json: Dict[str, Any],
     caption_plan_result: Dict[str, Any],
     rag_results: List[Dict[str, str]],
+    *,
+    route: Optional[Dict[str, Any]] = None,
 ) -> str:
     """
     Caption Writer:
@@ -333,10 +408,9 @@ def run_caption_writer(
         raise ValueError(f"writing_style not found for template: {selected_template}")
 
     # 2. system prompt 構築
-    system_prompt = (
-        caption_writer_prompt
-        + "\n\n### Writing Style\n"
-        + json.dumps(writing_style, ensure_ascii=False, indent=2)
+    system_prompt = build_system_prompt(
+        caption_writer_prompt,
+        [("Writing Style", writing_style)],
     )
 
     # 3. モデルへ渡す payload
@@ -349,10 +423,13 @@ def run_caption_writer(
     }
 
     # 4. GPT 呼び出し
-    caption = run_gpt(
+    caption = model_router.run_stage(
+        "caption_writer",
+        run_gpt,
+        route,
         prompt=json.dumps(payload, ensure_ascii=False),
         history=[{"role": "system", "content": system_prompt}],
-        max_completion_tokens=2048,
+        prompt_cache_key=prompt_cache_key("caption_writer", system_prompt),
     )
 
     return caption
@@ -368,13 +445,23 @@ def run_caption_writer(
 def generate_instagram_caption(
     user_input: Dict[str, Any],
     templates_json: Dict[str, Any],
+    *,
+    deep_rag: bool = False,
+    model: Optional[str] = None,
+    routes: Optional[Dict[str, Dict[str, Any]]] = None,
+    use_plan_cache: bool = True,
 ) -> Dict[str, Any]:
     """
     Instagram 自動投稿生成のフルパイプライン。
     - Template Selector
     - Caption Planner
-    - Web RAG
+    - Web RAG（deep_rag=True でページ本文の BM25 パッセージ検索も行う）
     - Caption Writer
+
+    各ステージのモデルは utils.model_router のルーティング設定に従う。
+    - model: 指定すると全ステージの主モデルを上書き（fallback は各ステージの設定のまま）
+    - routes: {stage: {"model", "fallback", "max_completion_tokens", "timeout"}} で部分上書き
+    - use_plan_cache: 類似の user_input の過去プランがあれば Planner の呼び出しを省く
     
     最終キャプションと中間結果すべて返す。
     """
@@ -385,17 +472,27 @@ def generate_instagram_caption(
     selector_output = run_template_selector(
         user_input=user_input,
         templates_json=templates_json,
+        route=model_router.resolve_route("template_selector", routes, model),
     )
     selected_template = selector_output["selected_template"]
 
     # ----------------------------------------
     # 2. Caption Planner（構造作成 & RAGクエリ生成）
     # ----------------------------------------
-    planner_output = run_caption_planner(
-        user_input=user_input,
-        selected_template=selected_template,
-        templates_json=templates_json,
-    )
+    cached_plan = plan_cache.lookup(user_input, selected_template) if use_plan_cache else None
+    if cached_plan is not None:
+        planner_output, similarity = cached_plan
+        plan_cache_info = {"hit": True, "similarity": similarity}
+    else:
+        planner_output = run_caption_planner(
+            user_input=user_input,
+            selected_template=selected_template,
+            templates_json=templates_json,
+            route=model_router.resolve_route("caption_planner", routes, model),
+        )
+        plan_cache_info = {"hit": False}
+        if use_plan_cache:
+            plan_cache.store(user_input, selected_template, planner_output)
 
     # 生成されたクエリ
     rag_queries = planner_output.get("query", [])
@@ -405,7 +502,7 @@ def generate_instagram_caption(
     # ----------------------------------------
     rag_results = []
     if rag_queries:
-        rag_results = web_rag_search(rag_queries)
+        rag_results = web_rag_search(rag_queries, deep=deep_rag)
 
     # ----------------------------------------
     # 4. Caption Writer（最終キャプション生成）
@@ -416,6 +513,7 @@ def generate_instagram_caption(
         templates_json=templates_json,
         caption_plan_result=planner_output,
         rag_results=rag_results,
+        route=model_router.resolve_route("caption_writer", routes, model),
     )
 
     # ----------------------------------------
@@ -424,6 +522,7 @@ def generate_instagram_caption(
     return {
         "template_selector": selector_output,
         "caption_planner": planner_output,
+        "plan_cache": plan_cache_info,
         "rag_results": rag_results,
         "final_caption": final_caption,
     }
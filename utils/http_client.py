@@ -0,0 +1,271 @@
+"""
+Shared HTTP transport for external APIs (Serper, Instagram Graph API).
+
+- ホスト単位でプールされた requests.Session を再利用
+- connect / read タイムアウト
+- 429 / 5xx に対するジッター付き指数バックオフのリトライ
+- ホスト単位のサーキットブレーカー
+- 冪等なリクエスト向けのヘッジリクエスト（テールレイテンシ対策）
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT: Tuple[float, float] = (3.05, 30.0)  # (connect, read)
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a host's circuit breaker is open and the call is short-circuited."""
+
+
+class CircuitBreaker:
+    """
+    Minimal per-host circuit breaker.
+
+    closed → (連続失敗が threshold 回) → open → (reset_timeout 経過) → half-open
+    half-open では 1 リクエストだけ通し、成功なら closed、失敗なら再び open。
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state_locked()
+
+    def _state_locked(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_request(self, host: str):
+        with self._lock:
+            state = self._state_locked()
+            if state == "open":
+                raise CircuitOpenError(f"Circuit open for host: {host}")
+            if state == "half-open":
+                if self._probe_in_flight:
+                    raise CircuitOpenError(f"Circuit half-open for host (probe in flight): {host}")
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+_sessions: Dict[str, requests.Session] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="http-hedge")
+
+
+def _host_of(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def new_session(pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    """
+    Create a Session with a connection pool and urllib3 retries disabled.
+    """
+    session = requests.Session()
+    # リトライは本モジュールで制御するので urllib3 側は 0
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(host: str) -> requests.Session:
+    """
+    Return the pooled Session for a host, creating it on first use.
+    """
+    with _registry_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = new_session()
+            _sessions[host] = session
+        return session
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """Breaker per host (or per explicit breaker_key)."""
+    with _registry_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _breakers[key] = breaker
+        return breaker
+
+
+def backoff_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+    """
+    Full-jitter exponential backoff. 429 の Retry-After（秒）があればそちらを優先。
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def _send_once(
+    method: str,
+    url: str,
+    timeout: Tuple[float, float],
+    session: Optional[requests.Session] = None,
+    breaker_key: Optional[str] = None,
+    use_breaker: bool = True,
+    **kwargs,
+) -> requests.Response:
+    host = _host_of(url)
+    if not use_breaker:
+        return (session or get_session(host)).request(method, url, timeout=timeout, **kwargs)
+
+    breaker_key = breaker_key or host
+    breaker = get_breaker(breaker_key)
+    breaker.before_request(breaker_key)
+
+    try:
+        response = (session or get_session(host)).request(method, url, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+def request(
+    method: str,
+    url: str,
+    *,
+    timeout: Tuple[float, float] = DEFAULT_TIMEOUT,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    idempotent: bool = True,
+    session: Optional[requests.Session] = None,
+    breaker_key: Optional[str] = None,
+    use_breaker: bool = True,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    Send an HTTP request through the shared transport.
+
+    session を渡すとホスト共有のプールではなくそのセッションを使う
+    （アカウントごとに接続プールを分けたい場合など）。
+    breaker_key を渡すとサーキットブレーカーをホスト単位ではなくそのキー単位で管理する
+    （あるアカウントの障害で他アカウントまで遮断しないため）。
+    use_breaker=False はサーキットブレーカーを使わない（不特定多数のホストに
+    1 回ずつアクセスするページ取得など。ホストごとの状態を溜め込まないため）。
+
+    - idempotent=True: 接続エラー・タイムアウト・429/5xx をリトライ
+    - idempotent=False: サーバーが処理していないことが確実なもの
+      （接続タイムアウト・429）のみリトライ。二重投稿を防ぐため。
+
+    リトライを使い切った場合は最後のレスポンスを返す（ステータス判定は呼び出し側）。
+    例外（タイムアウト等）の場合は最後の例外を送出する。
+    """
+    attempt = 0
+    while True:
+        try:
+            response = _send_once(method, url, timeout, session, breaker_key, use_breaker, **kwargs)
+        except CircuitOpenError:
+            raise
+        except requests.ConnectionError as exc:
+            # 非冪等リクエストは送信前に失敗したことが確実な接続タイムアウトのみリトライ
+            retryable = idempotent or isinstance(exc, requests.ConnectTimeout)
+            if not retryable or attempt >= max_retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        except requests.Timeout:
+            if not idempotent or attempt >= max_retries:
+                raise
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS_CODES)
+        if not retryable or attempt >= max_retries:
+            return response
+
+        delay = backoff_delay(attempt, response)
+        # stream=True の場合に破棄する試行の接続をプールへ返す
+        response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def post(url: str, **kwargs: Any) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get(url: str, **kwargs: Any) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def hedged_request(
+    method: str,
+    url: str,
+    *,
+    hedge_after: float = 1.0,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    Hedged request for idempotent calls only (e.g. Serper search).
+
+    1本目が hedge_after 秒以内に返らなければ同じリクエストをもう1本投げ、
+    先に成功した方を採用する。両方失敗した場合は1本目の結果（例外）を返す。
+    """
+    kwargs["idempotent"] = True
+    primary = _hedge_executor.submit(request, method, url, **kwargs)
+    done, _ = wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+
+    backup = _hedge_executor.submit(request, method, url, **kwargs)
+    pending = {primary, backup}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().ok:
+                return future.result()
+
+    return primary.result()
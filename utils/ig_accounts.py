@@ -0,0 +1,251 @@
+"""
+Instagram account registry.
+
+複数のクライアントアカウントを 1 プロセスで扱うためのレジストリ。
+アカウントごとに
+- IG ユーザー ID / アクセストークン
+- 専用の接続プール（requests.Session）
+- レート制限の予算（1時間あたりの API 呼び出し数）
+を持つ。
+
+IG_ACCOUNTS_FILE（JSON）の形式:
+{
+  "accounts": [
+    {"name": "client_a", "ig_user_id": "...", "access_token_env": "CLIENT_A_TOKEN", "calls_per_hour": 200},
+    {"name": "client_b", "ig_user_id": "...", "access_token": "..."}
+  ]
+}
+IG_USER_ID / IG_ACCESS_TOKEN が設定されていれば "default" アカウントとしても登録する。
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import dotenv
+import requests
+
+from utils import http_client
+
+dotenv.load_dotenv()
+
+GRAPH_API_BASE = "https://graph.facebook.com/v24.0"
+DEFAULT_ACCOUNT_NAME = "default"
+DEFAULT_CALLS_PER_HOUR = 200
+ACCOUNT_POOL_MAXSIZE = 4
+
+
+class RateLimiter:
+    """
+    Sliding-window limiter: at most max_calls per window seconds.
+    予算を超える場合は空きが出るまでブロックする。
+    """
+
+    def __init__(self, max_calls: int, window: float = 3600.0):
+        self.max_calls = max_calls
+        self.window = window
+        self._calls: deque = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: Optional[float] = None):
+        """
+        deadline（time.monotonic() 基準）までに枠が空かない場合は TimeoutError。
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.window:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                wait_for = self.window - (now - self._calls[0])
+            if deadline is not None and now + wait_for > deadline:
+                raise TimeoutError("Rate limit budget would not free up before the deadline.")
+            time.sleep(wait_for)
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            now = time.monotonic()
+            used = sum(1 for t in self._calls if now - t < self.window)
+            return self.max_calls - used
+
+
+class InstagramAccount:
+    """One Instagram business account with its own token, session and rate budget."""
+
+    def __init__(
+        self,
+        name: str,
+        ig_user_id: str,
+        access_token: str,
+        *,
+        calls_per_hour: int = DEFAULT_CALLS_PER_HOUR,
+    ):
+        if not ig_user_id or not access_token:
+            raise ValueError(f"ig_user_id / access_token が未設定のアカウントです: {name}")
+        self.name = name
+        self.ig_user_id = ig_user_id
+        self.access_token = access_token
+        self.session = http_client.new_session(pool_maxsize=ACCOUNT_POOL_MAXSIZE)
+        self.limiter = RateLimiter(calls_per_hour)
+        # サーキットブレーカーもアカウント単位（1 アカウントの障害で他を遮断しない）
+        self.breaker_key = f"instagram:{name}"
+
+    def __repr__(self) -> str:
+        return f"InstagramAccount(name={self.name!r}, ig_user_id={self.ig_user_id!r})"
+
+    def graph_post(self, edge: str, params: Dict[str, Any], *, idempotent: bool = True) -> requests.Response:
+        """
+        POST to /{ig_user_id}/{edge} with this account's token, session and rate budget.
+        """
+        self.limiter.acquire()
+        url = f"{GRAPH_API_BASE}/{self.ig_user_id}/{edge}"
+        return http_client.post(
+            url,
+            params={**params, "access_token": self.access_token},
+            session=self.session,
+            breaker_key=self.breaker_key,
+            idempotent=idempotent,
+        )
+
+    def graph_get(
+        self,
+        object_id: str,
+        params: Optional[Dict[str, Any]] = None,
+        *,
+        deadline: Optional[float] = None,
+    ) -> requests.Response:
+        """
+        GET /{object_id} (e.g. container status) with this account's token and rate budget.
+        deadline を過ぎてまでレート制限の空きを待たない。
+        """
+        self.limiter.acquire(deadline)
+        url = f"{GRAPH_API_BASE}/{object_id}"
+        return http_client.get(
+            url,
+            params={**(params or {}), "access_token": self.access_token},
+            session=self.session,
+            breaker_key=self.breaker_key,
+        )
+
+
+    def graph_get_many(
+        self,
+        object_ids: Iterable[str],
+        params: Optional[Dict[str, Any]] = None,
+        *,
+        deadline: Optional[float] = None,
+    ) -> requests.Response:
+        """
+        GET /?ids=a,b,c — 複数オブジェクトを 1 回の呼び出し（レート予算 1 つ分）で取得する。
+        レスポンスは {object_id: {...}}。
+        """
+        self.limiter.acquire(deadline)
+        return http_client.get(
+            f"{GRAPH_API_BASE}/",
+            params={**(params or {}), "ids": ",".join(object_ids), "access_token": self.access_token},
+            session=self.session,
+            breaker_key=self.breaker_key,
+        )
+
+
+class AccountRegistry:
+    """
+    Name → InstagramAccount mapping.
+
+    loader を渡すと初回アクセス時に一度だけ呼ぶ（import 時に設定ファイルを読まない）。
+    """
+
+    def __init__(self, loader: Optional[Callable[["AccountRegistry"], None]] = None):
+        self._accounts: Dict[str, InstagramAccount] = {}
+        self._lock = threading.RLock()
+        self._loader = loader
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if self._loader is not None:
+                loader, self._loader = self._loader, None
+                loader(self)
+
+    def register(self, account: InstagramAccount) -> InstagramAccount:
+        self._ensure_loaded()
+        with self._lock:
+            self._accounts[account.name] = account
+        return account
+
+    def get(self, name: str) -> InstagramAccount:
+        self._ensure_loaded()
+        with self._lock:
+            account = self._accounts.get(name)
+        if account is None:
+            raise KeyError(f"Unknown Instagram account: {name}")
+        return account
+
+    def get_many(self, names: Optional[Iterable[str]] = None) -> List[InstagramAccount]:
+        """names が None なら登録済みの全アカウント。"""
+        self._ensure_loaded()
+        if names is None:
+            with self._lock:
+                return list(self._accounts.values())
+        return [self.get(n) for n in names]
+
+    def names(self) -> List[str]:
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._accounts)
+
+    def load_file(self, path: str):
+        """
+        Register accounts from a JSON file. 不正なエントリは警告を出してスキップする。
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        for entry in data.get("accounts", []):
+            try:
+                token = entry.get("access_token")
+                if not token and entry.get("access_token_env"):
+                    token = os.getenv(entry["access_token_env"])
+                account = InstagramAccount(
+                    entry["name"],
+                    str(entry.get("ig_user_id", "")),
+                    token or "",
+                    calls_per_hour=entry.get("calls_per_hour", DEFAULT_CALLS_PER_HOUR),
+                )
+            except (KeyError, TypeError, ValueError, AttributeError) as exc:
+                print(f"WARN: skipping invalid Instagram account entry in {path}: {exc}")
+                continue
+            self.register(account)
+
+
+def _load_default_accounts(reg: AccountRegistry):
+    ig_user_id = os.getenv("IG_USER_ID")
+    access_token = os.getenv("IG_ACCESS_TOKEN")
+    if ig_user_id and access_token:
+        reg.register(InstagramAccount(DEFAULT_ACCOUNT_NAME, ig_user_id, access_token))
+
+    accounts_file = os.getenv("IG_ACCOUNTS_FILE")
+    if accounts_file:
+        try:
+            reg.load_file(accounts_file)
+        except (OSError, ValueError) as exc:
+            # 複数アカウント設定の不備で単一アカウント投稿まで止めない
+            print(f"WARN: could not load IG_ACCOUNTS_FILE {accounts_file}: {exc}")
+
+
+registry = AccountRegistry(loader=_load_default_accounts)
+
+
+def get_account(account: Optional[InstagramAccount] = None) -> InstagramAccount:
+    """
+    Resolve an optional account argument, falling back to the "default" account
+    (IG_USER_ID / IG_ACCESS_TOKEN).
+    """
+    if account is not None:
+        return account
+    return registry.get(DEFAULT_ACCOUNT_NAME)
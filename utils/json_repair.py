@@ -0,0 +1,162 @@
+"""
+Tolerant JSON extraction and light schema validation for LLM output.
+
+モデルの JSON 出力には
+- ```json ... ``` のコードフェンス
+- 前後の説明文
+- max_output_tokens による途中切れ
+が混ざることがある。ここでは LLM を呼び直さずに復元できるものは復元し、
+呼び出し側（utils.llm.run_gpt_json）は復元できなかった場合だけ再問い合わせする。
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# フィールド名 → 許容する型（tuple 可）
+Schema = Dict[str, Any]
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_DANGLING_KEY_RE = re.compile(r',?\s*"(?:[^"\\]|\\.)*"\s*:\s*$')
+MAX_TRIM_ATTEMPTS = 10
+
+
+def strip_code_fences(text: str) -> str:
+    match = _FENCE_RE.search(text)
+    return match.group(1) if match else text
+
+
+def _scan(text: str) -> Tuple[Optional[int], List[str], bool, bool, List[int]]:
+    """
+    Walk text (starting at an opening brace) tracking nesting outside strings.
+
+    Returns (end index of the balanced object or None, open-bracket stack,
+    inside-string flag, pending-escape flag, positions of commas outside strings).
+    """
+    stack: List[str] = []
+    commas: List[int] = []
+    in_str = False
+    esc = False
+
+    for i, ch in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+            continue
+
+        if ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return i, stack, False, False, commas
+        elif ch == ",":
+            commas.append(i)
+
+    return None, stack, in_str, esc, commas
+
+
+def _close_truncated(fragment: str) -> str:
+    """
+    Close an unterminated string and all open brackets; drop a trailing comma or dangling key.
+    """
+    _, stack, in_str, esc, _ = _scan(fragment)
+    if in_str:
+        fragment = (fragment[:-1] if esc else fragment) + '"'
+    fragment = fragment.rstrip().rstrip(",").rstrip()
+    fragment = _DANGLING_KEY_RE.sub("", fragment)
+    closers = "".join("}" if c == "{" else "]" for c in reversed(stack))
+    return fragment + closers
+
+
+def _repair_truncated(fragment: str) -> Dict[str, Any]:
+    """
+    Try closing the fragment as-is, then progressively cut back to earlier commas
+    （途中で切れた数値・キーなどを捨てる）.
+    """
+    candidates = [fragment]
+    _, _, _, _, commas = _scan(fragment)
+    candidates.extend(fragment[:pos] for pos in reversed(commas[-MAX_TRIM_ATTEMPTS:]))
+
+    for candidate in candidates:
+        try:
+            data = json.loads(_close_truncated(candidate))
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return data
+    raise ValueError("Could not repair truncated JSON object.")
+
+
+def extract_json_object(text: str) -> Tuple[Dict[str, Any], bool]:
+    """
+    Extract one JSON object from model output.
+
+    Returns (data, repaired). repaired は素の json.loads では読めず、
+    フェンス除去・前後テキスト除去・途中切れ補修のいずれかを行った場合に True。
+    Raises ValueError if no object can be recovered.
+    """
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data, False
+    except ValueError:
+        pass
+
+    # フェンス内の文字列に ``` が含まれることがあるので、まず生のテキストで
+    # 対応の取れたオブジェクトを探し、読めなかった場合だけフェンスを外す
+    start = text.find("{")
+    if start >= 0:
+        end = _scan(text[start:])[0]
+        if end is not None:
+            try:
+                data = json.loads(text[start: start + end + 1])
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                return data, True
+
+    body = strip_code_fences(text)
+    start = body.find("{")
+    if start < 0:
+        raise ValueError("No JSON object found in model output.")
+
+    fragment = body[start:]
+    end = _scan(fragment)[0]
+    if end is not None:
+        data = json.loads(fragment[: end + 1])
+        if not isinstance(data, dict):
+            raise ValueError("Model output is not a JSON object.")
+        return data, True
+
+    return _repair_truncated(fragment), True
+
+
+def validate_schema(data: Dict[str, Any], schema: Schema) -> List[str]:
+    """
+    Check required keys and their types. Returns a list of problems (empty if valid).
+    """
+    errors = []
+    for key, expected in schema.items():
+        if key not in data:
+            errors.append(f"missing field: {key}")
+        elif not isinstance(data[key], expected):
+            names = "/".join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))
+            errors.append(f"{key} must be {names}")
+    return errors
+
+
+def describe_schema(schema: Schema) -> str:
+    """Compact schema description for the repair prompt."""
+    fields = []
+    for key, expected in schema.items():
+        types = expected if isinstance(expected, tuple) else (expected,)
+        fields.append(f'"{key}": {"/".join(t.__name__ for t in types)}')
+    return "{ " + ", ".join(fields) + " }"
@@ -2,9 +2,10 @@
 Helper for calling the GPT5-nano chat model with a prompt and conversation history.
 """
 
-import json
-from typing import Dict, List, Optional, Sequence
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 import os
+import threading
+import time
 
 try:
     # Load environment variables from a local .env file when available.
@@ -15,11 +16,16 @@ except ImportError:
     # python-dotenv is optional; skip loading if it is not installed.
     pass
 
-from openai import OpenAI
+from openai import InternalServerError, OpenAI, RateLimitError
+
+from utils.http_client import backoff_delay
+from utils.json_repair import Schema, describe_schema, extract_json_object, validate_schema
 
 ChatMessage = Dict[str, str]
 
 DEFAULT_MODEL = "gpt-4.1-nano"
+# timeout 指定時に 429 / 5xx を再試行する回数（タイムアウトは再試行しない）
+TRANSIENT_MAX_RETRIES = 2
 JSON_ONLY_SYSTEM_PROMPT = (
     "You are a strict JSON responder. Reply with exactly one JSON object and nothing else; "
     "no markdown, no code fences, no prose. If unsure, return an object with an 'error' field."
@@ -79,57 +85,202 @@ def build_messages(prompt: str, history: Optional[Sequence[ChatMessage]] = None)
     return messages
 
 
+# Provider-side prompt cache の累計（cached_tokens / input_tokens でヒット率を確認できる）
+usage_stats: Dict[str, int] = {
+    "calls": 0,
+    "input_tokens": 0,
+    "cached_tokens": 0,
+    "output_tokens": 0,
+}
+# usage_stats / json_stats はワーカーのスレッドから並行に更新される
+_stats_lock = threading.Lock()
+
+
+def _record_usage(response, prompt_cache_key: Optional[str]) -> Dict[str, int]:
+    """
+    Accumulate token usage (including cached input tokens) from a Responses API reply.
+    """
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "input_tokens_details", None)
+    record = {
+        "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+        "cached_tokens": getattr(details, "cached_tokens", 0) or 0,
+        "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+    }
+
+    with _stats_lock:
+        usage_stats["calls"] += 1
+        for key, value in record.items():
+            usage_stats[key] += value
+
+    print(
+        f"USAGE [{prompt_cache_key or '-'}]: input={record['input_tokens']} "
+        f"cached={record['cached_tokens']} output={record['output_tokens']}"
+    )
+    return record
+
+
+def _create_with_deadline(messages, model, max_completion_tokens, timeout: float, extra: Dict[str, Any]):
+    """
+    timeout をステージ全体の締め切りとして Responses API を呼ぶ。
+
+    SDK の自動リトライはタイムアウトも再試行するため（20 秒のルートが 60 秒以上になる）
+    max_retries=0 にし、429 / 5xx だけを締め切りの残り時間内で再試行する。
+    タイムアウトはそのまま送出し、run_stage が fallback モデルに切り替える。
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        api = client.with_options(timeout=remaining, max_retries=0)
+        try:
+            return api.responses.create(
+                model=model,
+                input=_as_response_input(messages),
+                max_output_tokens=max_completion_tokens,
+                **extra,
+            )
+        except (RateLimitError, InternalServerError) as exc:
+            delay = backoff_delay(attempt, exc.response)
+            # 待った後に 1 秒も残らないなら諦めて fallback に任せる
+            if attempt >= TRANSIENT_MAX_RETRIES or time.monotonic() + delay + 1.0 >= deadline:
+                raise
+            print(f"WARN: {model} {type(exc).__name__}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def _create_response(
+    prompt: str,
+    history: Optional[Sequence[ChatMessage]],
+    *,
+    model: str,
+    max_completion_tokens: Optional[int],
+    prompt_cache_key: Optional[str],
+    timeout: Optional[float] = None,
+):
+    messages = build_messages(prompt, history)
+
+    extra = {}
+    if prompt_cache_key:
+        extra["prompt_cache_key"] = prompt_cache_key
+
+    if timeout:
+        response = _create_with_deadline(messages, model, max_completion_tokens, timeout, extra)
+    else:
+        response = client.responses.create(
+            model=model,
+            input=_as_response_input(messages),
+            max_output_tokens=max_completion_tokens,
+            **extra,
+        )
+
+    print("DEBUG RAW PROMPT:", prompt)
+    print("DEBUG RAW HISTORY:", history)
+    print("DEBUG RAW RESPONSE:", response)
+    _record_usage(response, prompt_cache_key)
+    return response
+
+
 def run_gpt(
     prompt: str,
     history: Optional[Sequence[ChatMessage]] = None,
     *,
     model: str = DEFAULT_MODEL,
     max_completion_tokens: Optional[int] = None,
+    prompt_cache_key: Optional[str] = None,
+    timeout: Optional[float] = None,
 ) -> str:
 
-    messages = build_messages(prompt, history)
-
-    response = client.responses.create(
+    response = _create_response(
+        prompt,
+        history,
         model=model,
-        input=[
-            {
-                "role": msg["role"],
-                "content": [{"type": "input_text", "text": msg["content"]}],
-            }
-            for msg in messages
-        ],
-        max_output_tokens=max_completion_tokens,
+        max_completion_tokens=max_completion_tokens,
+        prompt_cache_key=prompt_cache_key,
+        timeout=timeout,
     )
-
-    print("DEBUG RAW PROMPT:", prompt)
-    print("DEBUG RAW HISTORY:", history)
-    print("DEBUG RAW RESPONSE:", response)
     return response.output[0].content[0].text
 
 
+# run_gpt_json の結果内訳（stage ごと）
+# parsed: そのまま読めた / repaired: ローカル補修で復元 / retried: 再問い合わせで復元 / failed: 失敗
+json_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _count_json(stage: Optional[str], outcome: str):
+    with _stats_lock:
+        counts = json_stats.setdefault(stage or "-", {"parsed": 0, "repaired": 0, "retried": 0, "failed": 0})
+        counts[outcome] += 1
+
+
+def _parse_json_output(text: str, schema: Optional[Schema]) -> Tuple[Optional[Dict[str, Any]], bool, str]:
+    """
+    Returns (data or None, repaired, error message).
+    """
+    try:
+        data, repaired = extract_json_object(text)
+    except ValueError as exc:
+        return None, False, str(exc)
+
+    if schema:
+        errors = validate_schema(data, schema)
+        if errors:
+            return None, repaired, "; ".join(errors)
+    return data, repaired, ""
+
+
 def run_gpt_json(
     prompt: str,
     history: Optional[Sequence[ChatMessage]] = None,
     *,
     model: str = DEFAULT_MODEL,
     max_completion_tokens: Optional[int] = None,
+    prompt_cache_key: Optional[str] = None,
+    schema: Optional[Schema] = None,
+    stage: Optional[str] = None,
+    timeout: Optional[float] = None,
 ):
-    messages = build_messages(prompt, history)
+    """
+    Call the model and return one JSON object.
 
-    response = client.responses.create(
+    出力はまずローカルで復元（フェンス除去・外側の {} 抽出・途中切れ補修）し、
+    schema があれば必須フィールドと型を検証する。それでも失敗した場合のみ、
+    壊れた出力だけを渡す小さな修正リクエストを 1 回投げる（元プロンプトは再送しない）。
+    """
+    response = _create_response(
+        prompt,
+        history,
         model=model,
-        input=[
-            {
-                "role": msg["role"],
-                "content": [{"type": "input_text", "text": msg["content"]}],
-            }
-            for msg in messages
-        ],
-        max_output_tokens=max_completion_tokens,
+        max_completion_tokens=max_completion_tokens,
+        prompt_cache_key=prompt_cache_key,
+        timeout=timeout,
     )
-    print("DEBUG RAW PROMPT:", prompt)
-    print("DEBUG RAW HISTORY:", history)
-    print("DEBUG RAW RESPONSE:", response)
 
-    content = response.output[0].content[0].text
-    return json.loads(content)
+    content = _extract_output_text(response)
+    data, repaired, error = _parse_json_output(content, schema)
+    if data is not None:
+        _count_json(stage, "repaired" if repaired else "parsed")
+        return data
+
+    repair_prompt = (
+        "The following output was supposed to be one JSON object"
+        + (f" matching {describe_schema(schema)}" if schema else "")
+        + f" but it is invalid ({error}). Return the corrected JSON object only.\n\n"
+        + content
+    )
+    retry_response = _create_response(
+        repair_prompt,
+        [{"role": "system", "content": JSON_ONLY_SYSTEM_PROMPT}],
+        model=model,
+        max_completion_tokens=max_completion_tokens,
+        prompt_cache_key=None,
+        timeout=timeout,
+    )
+    data, _, retry_error = _parse_json_output(_extract_output_text(retry_response), schema)
+    if data is None:
+        _count_json(stage, "failed")
+        raise ValueError(f"Model did not return valid JSON{f' for {stage}' if stage else ''}: {retry_error}")
+
+    _count_json(stage, "retried")
+    return data
@@ -0,0 +1,159 @@
+"""
+Per-stage model routing with fallback and latency tracking.
+
+ステージごとに使うモデル・最大出力トークン・タイムアウトを決め、
+タイムアウトやエラー時は fallback モデルで 1 回だけ再実行する。
+モデルごとの実測レイテンシを latency_stats に蓄積するので、
+コストとレイテンシのバランスをステージ単位で調整できる。
+
+MODEL_ROUTES_FILE（JSON）で既定値を上書きできる:
+{
+  "caption_writer": {"model": "gpt-4.1", "fallback": "gpt-4.1-mini", "timeout": 60}
+}
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from openai import OpenAIError
+
+Route = Dict[str, Any]
+
+# 選択・構成は安価で速いモデル、最終キャプションだけ上位モデル
+DEFAULT_ROUTES: Dict[str, Route] = {
+    "template_selector": {
+        "model": "gpt-4.1-nano",
+        "fallback": "gpt-4.1-mini",
+        "max_completion_tokens": 1024,
+        "timeout": 20,
+    },
+    "caption_planner": {
+        "model": "gpt-4.1-nano",
+        "fallback": "gpt-4.1-mini",
+        "max_completion_tokens": 1024,
+        "timeout": 30,
+    },
+    "caption_writer": {
+        "model": "gpt-4.1",
+        "fallback": "gpt-4.1-mini",
+        "max_completion_tokens": 2048,
+        "timeout": 60,
+    },
+    "template_generator": {
+        "model": "gpt-4.1-mini",
+        "fallback": "gpt-4.1-nano",
+        "max_completion_tokens": 2048,
+        "timeout": 60,
+    },
+}
+
+LATENCY_EWMA_ALPHA = 0.2
+
+
+def _load_routes() -> Dict[str, Route]:
+    routes = {stage: dict(route) for stage, route in DEFAULT_ROUTES.items()}
+    path = os.getenv("MODEL_ROUTES_FILE")
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            for stage, override in json.load(f).items():
+                routes.setdefault(stage, {}).update(override)
+    return routes
+
+
+routes = _load_routes()
+
+
+def resolve_route(
+    stage: str,
+    overrides: Optional[Dict[str, Route]] = None,
+    model: Optional[str] = None,
+) -> Route:
+    """
+    Merge the configured route for a stage with per-call overrides.
+    model を指定すると全ステージの主モデルをそれで置き換える。
+    """
+    route = dict(routes.get(stage, {}))
+    if overrides and stage in overrides:
+        route.update(overrides[stage])
+    if model:
+        route["model"] = model
+    if "model" not in route:
+        raise ValueError(f"No model configured for stage: {stage}")
+    return route
+
+
+# ========================================
+#  レイテンシ計測
+# ========================================
+# model → {"calls", "errors", "total_seconds", "ewma_seconds", "last_seconds"}
+latency_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+
+def _record_latency(model: str, seconds: float, ok: bool):
+    with _stats_lock:
+        stats = latency_stats.setdefault(
+            model,
+            {"calls": 0, "errors": 0, "total_seconds": 0.0, "ewma_seconds": seconds, "last_seconds": 0.0},
+        )
+        stats["calls"] += 1
+        if not ok:
+            stats["errors"] += 1
+        stats["total_seconds"] += seconds
+        stats["last_seconds"] = seconds
+        stats["ewma_seconds"] += LATENCY_EWMA_ALPHA * (seconds - stats["ewma_seconds"])
+
+
+def latency_summary() -> Dict[str, Dict[str, float]]:
+    """モデルごとの平均・EWMA レイテンシとエラー率"""
+    with _stats_lock:
+        return {
+            model: {
+                "calls": s["calls"],
+                "error_rate": round(s["errors"] / s["calls"], 3),
+                "avg_seconds": round(s["total_seconds"] / s["calls"], 3),
+                "ewma_seconds": round(s["ewma_seconds"], 3),
+            }
+            for model, s in latency_stats.items()
+        }
+
+
+# ========================================
+#  実行（フォールバック付き）
+# ========================================
+def run_stage(stage: str, call: Callable[..., Any], route: Optional[Route] = None, **kwargs: Any) -> Any:
+    """
+    Run call (run_gpt / run_gpt_json) for a stage with the routed model.
+
+    call には model / max_completion_tokens / timeout を route から渡す。
+    主モデルがタイムアウト・API エラー・JSON 失敗（ValueError）の場合は
+    fallback モデルで 1 回だけ再実行する。
+    """
+    route = route or resolve_route(stage)
+    models = [route["model"]]
+    if route.get("fallback") and route["fallback"] != route["model"]:
+        models.append(route["fallback"])
+
+    last_exc: Optional[Exception] = None
+    for model in models:
+        started = time.monotonic()
+        try:
+            result = call(
+                model=model,
+                max_completion_tokens=route.get("max_completion_tokens"),
+                timeout=route.get("timeout"),
+                **kwargs,
+            )
+        except (OpenAIError, ValueError) as exc:
+            _record_latency(model, time.monotonic() - started, ok=False)
+            print(f"WARN: {stage} failed on {model}: {type(exc).__name__}: {exc}")
+            last_exc = exc
+            continue
+
+        _record_latency(model, time.monotonic() - started, ok=True)
+        return result
+
+    raise last_exc
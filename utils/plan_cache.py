@@ -0,0 +1,225 @@
+"""
+Similarity-keyed cache of Caption Planner outputs.
+
+user_input は business_type / direction が同じで title だけ少し違う、という
+ほぼ重複の投稿が多い。ここでは
+- (selected_template, business_type, 正規化した direction) が一致するものを候補にし
+- title に含まれる数字（価格・割引率・日付など）が完全に一致し
+- title の内容語（地名・店舗名・商品名など）がすべて対応し（複数形程度の揺れは許容）
+- title の文字 n-gram コサイン類似度が閾値以上なら
+前回の caption_plan / query を再利用して Planner の LLM 呼び出しを省く。
+（direction を類似度に混ぜると、共通の direction だけで閾値を超えてしまうため。
+長い title では「京都」→「奈良」のような 1 語の違いでも類似度が閾値を超えるので、
+語単位でも確認する。Planner は title を言い換えるため、置換での補正には頼らない）
+user_input の title 以外のフィールド（business_type / direction を含む）は
+Planner のプロンプトにそのまま入るので、すべてバケットのキーに含める。
+query が同じになるので、下流の Serper 検索もキャッシュヒットする。
+
+PLAN_CACHE_FILE を指定すると JSON に保存し、プロセスをまたいで再利用する。
+ファイルが壊れている・読めない場合は警告を出して空のキャッシュで始める。
+"""
+
+import copy
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+PLAN_CACHE_FILE = os.getenv("PLAN_CACHE_FILE")
+PLAN_CACHE_THRESHOLD = float(os.getenv("PLAN_CACHE_THRESHOLD", "0.85"))
+MAX_ENTRIES_PER_BUCKET = 50
+NGRAM_SIZE = 3
+# 語同士をこの類似度以上なら同じ語とみなす（latte / lattes, tour / tours）
+WORD_MATCH_THRESHOLD = 0.6
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+_WORD_RE = re.compile(r"[a-z]+|[぀-ヿ㐀-䶿一-鿿가-힯]+")
+_STOPWORDS = frozenset(
+    "a an and the of for to in on at with by from our your my new all this that is are".split()
+)
+
+
+def normalize(text: Any) -> str:
+    """NFKC・小文字化・空白の正規化"""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    return " ".join(text.split())
+
+
+def char_ngrams(text: str, n: int = NGRAM_SIZE) -> Counter:
+    """
+    Character n-grams (空白区切りのない日本語でも使える)。
+    """
+    padded = f" {text} "
+    if len(padded) <= n:
+        return Counter([padded])
+    return Counter(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def cosine_similarity(a: Counter, b: Counter) -> float:
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def _bucket_key(user_input: Dict[str, Any], selected_template: str) -> str:
+    parts = [normalize(selected_template), normalize(user_input.get("business_type")), normalize(user_input.get("direction"))]
+    extra = {k: normalize(v) for k, v in user_input.items() if k not in ("business_type", "title", "direction")}
+    if extra:
+        parts.append(json.dumps(extra, ensure_ascii=False, sort_keys=True))
+    return "|".join(parts)
+
+
+def _signature(user_input: Dict[str, Any]) -> str:
+    return normalize(user_input.get("title"))
+
+
+def _numbers(signature: str) -> List[str]:
+    """「10% off」と「30% off」は別プランにする"""
+    return _NUMBER_RE.findall(signature)
+
+
+def _content_words(signature: str) -> List[str]:
+    """
+    Title words that carry meaning. 英語は単語（ストップワード除く）、
+    日本語など空白のない文字列は文字 bigram。数字は _numbers で別に比較する。
+    """
+    words: List[str] = []
+    for chunk in _WORD_RE.findall(signature):
+        if _CJK_RE.match(chunk):
+            if len(chunk) == 1:
+                words.append(chunk)
+            else:
+                words.extend(chunk[i:i + 2] for i in range(len(chunk) - 1))
+        elif chunk not in _STOPWORDS:
+            words.append(chunk)
+    return words
+
+
+def _words_match(a: str, b: str) -> bool:
+    """
+    両方の title の内容語が、それぞれ相手側に対応する語を持つか。
+    1 語でも対応しない語（Kyoto ↔ Nara など）があれば別の投稿とみなす。
+    """
+    a_words, b_words = set(_content_words(a)), set(_content_words(b))
+
+    def covered(words, others):
+        return all(
+            w in others or any(cosine_similarity(char_ngrams(w), char_ngrams(o)) >= WORD_MATCH_THRESHOLD for o in others)
+            for w in words
+        )
+
+    return covered(a_words, b_words) and covered(b_words, a_words)
+
+
+def _adapt(planner_output: Dict[str, Any], old_title: str, new_title: str) -> Dict[str, Any]:
+    """
+    Lightly adapt a cached plan: 旧 title が含まれていれば（大文字小文字を問わず）新 title に置き換える。
+    """
+    if not old_title or not new_title or old_title == new_title:
+        return copy.deepcopy(planner_output)
+
+    pattern = re.compile(re.escape(old_title), re.IGNORECASE)
+
+    def replace(value):
+        if isinstance(value, str):
+            return pattern.sub(lambda _: new_title, value)
+        if isinstance(value, list):
+            return [replace(v) for v in value]
+        if isinstance(value, dict):
+            return {k: replace(v) for k, v in value.items()}
+        return value
+
+    return replace(planner_output)
+
+
+class PlanCache:
+    """Buckets of prior planner outputs, searched by n-gram similarity."""
+
+    def __init__(
+        self,
+        path: Optional[str] = PLAN_CACHE_FILE,
+        threshold: float = PLAN_CACHE_THRESHOLD,
+        max_entries_per_bucket: int = MAX_ENTRIES_PER_BUCKET,
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries_per_bucket = max_entries_per_bucket
+        self._buckets: Dict[str, "OrderedDict[str, Dict[str, Any]]"] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+        if path and os.path.exists(path):
+            self._load()
+
+    def lookup(
+        self,
+        user_input: Dict[str, Any],
+        selected_template: str,
+    ) -> Optional[Tuple[Dict[str, Any], float]]:
+        """
+        Returns (adapted planner_output, similarity) for the closest prior plan
+        above the threshold, or None.
+        """
+        signature = _signature(user_input)
+        grams = char_ngrams(signature)
+        numbers = _numbers(signature)
+
+        with self._lock:
+            bucket = self._buckets.get(_bucket_key(user_input, selected_template), {})
+            best: Optional[Tuple[float, str, Dict[str, Any]]] = None
+            for sig, entry in bucket.items():
+                if _numbers(sig) != numbers or not _words_match(signature, sig):
+                    continue
+                score = 1.0 if sig == signature else cosine_similarity(grams, char_ngrams(sig))
+                if best is None or score > best[0]:
+                    best = (score, sig, entry)
+
+            if best is None or best[0] < self.threshold:
+                self.stats["misses"] += 1
+                return None
+
+            bucket.move_to_end(best[1])
+            self.stats["hits"] += 1
+            entry = best[2]
+
+        adapted = _adapt(entry["planner_output"], entry.get("title", ""), str(user_input.get("title") or ""))
+        return adapted, round(best[0], 3)
+
+    def store(self, user_input: Dict[str, Any], selected_template: str, planner_output: Dict[str, Any]):
+        key = _bucket_key(user_input, selected_template)
+        with self._lock:
+            bucket = self._buckets.setdefault(key, OrderedDict())
+            bucket[_signature(user_input)] = {
+                "title": str(user_input.get("title") or ""),
+                "planner_output": copy.deepcopy(planner_output),
+            }
+            bucket.move_to_end(_signature(user_input))
+            while len(bucket) > self.max_entries_per_bucket:
+                bucket.popitem(last=False)
+            if self.path:
+                self._save_locked()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._buckets = {key: OrderedDict(entries) for key, entries in data.items()}
+        except (OSError, ValueError, AttributeError, TypeError) as exc:
+            # キャッシュは任意なので、壊れたファイルでキャプション生成まで止めない
+            print(f"WARN: could not load PLAN_CACHE_FILE {self.path}: {exc}")
+            self._buckets = {}
+
+    def _save_locked(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._buckets, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+plan_cache = PlanCache()
@@ -1,9 +1,18 @@
 import os
+import re
+import json
 import time
+import hashlib
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
 import requests
 from google.cloud import storage
 
+from utils import http_client
+from utils.ig_accounts import get_account, registry
+
 # ----------------------------------------
 # .env 読み込み
 # ----------------------------------------
@@ -11,8 +20,18 @@ dotenv.load_dotenv()
 
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
-IG_USER_ID = os.getenv("IG_USER_ID")
-ACCESS_TOKEN = os.getenv("IG_ACCESS_TOKEN")
+
+# 再開可能アップロードの状態（セッションURL）を保存するディレクトリ
+UPLOAD_STATE_DIR = os.getenv("UPLOAD_STATE_DIR", ".upload_state")
+GCS_CHUNK_SIZE = 8 * 1024 * 1024          # 256KiB の倍数である必要がある
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024     # これより大きいファイル・動画は分割アップロード
+MAX_UPLOAD_RECOVERIES = 5
+
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".m4v"}
+CONTAINER_POLL_INTERVAL = 5
+CONTAINER_POLL_MAX_INTERVAL = 30          # ポーリング間隔は 1.5 倍ずつ伸ばしてここで頭打ち
+CONTAINER_POLL_BACKOFF = 1.5
+CONTAINER_TIMEOUT = 15 * 60
 
 
 # ========================================
@@ -40,8 +59,21 @@ ACCESS_TOKEN = os.getenv("IG_ACCESS_TOKEN")
 
     #return url
 
+_storage_client = None
+_storage_lock = threading.Lock()
+
+
+def _get_storage_client():
+    """storage.Client はスレッドセーフなので 1 つを使い回す"""
+    global _storage_client
+    with _storage_lock:
+        if _storage_client is None:
+            _storage_client = storage.Client()
+        return _storage_client
+
+
 def upload_to_gcs(local_path, dest_path):
-    client = storage.Client()
+    client = _get_storage_client()
     bucket = client.bucket(GCS_BUCKET_NAME)
     blob = bucket.blob(dest_path)
 
@@ -55,51 +87,248 @@ def upload_to_gcs(local_path, dest_path):
     return f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{dest_path}"
 
 
+# ========================================
+#  GCS 再開可能（分割）アップロード
+# ========================================
+def _upload_state_path(local_path, dest_path):
+    """ファイル内容が変わったら別セッションになるよう size / mtime もキーに含める"""
+    st = os.stat(local_path)
+    key = f"{os.path.abspath(local_path)}|{dest_path}|{st.st_size}|{st.st_mtime_ns}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+    return os.path.join(UPLOAD_STATE_DIR, f"{digest}.json")
+
+
+def _load_session_url(state_path):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("session_url")
+    except (OSError, ValueError):
+        return None
+
+
+def _save_session_url(state_path, session_url):
+    os.makedirs(UPLOAD_STATE_DIR, exist_ok=True)
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump({"session_url": session_url}, f)
+
+
+def _committed_offset(response):
+    """308 レスポンスの Range ヘッダ（bytes=0-N）から次に送るべき位置を返す"""
+    match = re.match(r"bytes=0-(\d+)", response.headers.get("Range", ""))
+    return int(match.group(1)) + 1 if match else 0
+
+
+def _query_upload_offset(session_url, total):
+    """セッションの受信済みバイト数を問い合わせる（完了済みなら total）"""
+    res = http_client.request(
+        "PUT", session_url, data=b"", headers={"Content-Range": f"bytes */{total}"}
+    )
+    if res.status_code in (200, 201):
+        return total
+    if res.status_code == 308:
+        return _committed_offset(res)
+    if res.status_code in (404, 410):
+        return None
+    raise RuntimeError(f"アップロード状態の取得に失敗: {res.status_code} {res.text}")
+
+
+def upload_to_gcs_resumable(local_path, dest_path, chunk_size=GCS_CHUNK_SIZE):
+    """
+    大きなファイル（動画など）を GCS の resumable upload で分割アップロードする。
+    - メモリ使用量は chunk_size 分のみ
+    - 通信エラー時はサーバー側の受信済み位置から再開（送信済みチャンクは再送しない）
+    - セッションURLを UPLOAD_STATE_DIR に保存するので、プロセス再起動後も途中から再開できる
+    """
+    total = os.path.getsize(local_path)
+    state_path = _upload_state_path(local_path, dest_path)
+
+    session_url = _load_session_url(state_path)
+    offset = _query_upload_offset(session_url, total) if session_url else None
+    if offset is None:
+        blob = _get_storage_client().bucket(GCS_BUCKET_NAME).blob(dest_path)
+        content_type = mimetypes.guess_type(local_path)[0] or "application/octet-stream"
+        session_url = blob.create_resumable_upload_session(content_type=content_type, size=total)
+        _save_session_url(state_path, session_url)
+        offset = 0
+
+    recoveries = 0
+    with open(local_path, "rb") as f:
+        while offset < total:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            end = offset + len(chunk) - 1
+
+            try:
+                res = http_client.request(
+                    "PUT",
+                    session_url,
+                    data=chunk,
+                    headers={"Content-Range": f"bytes {offset}-{end}/{total}"},
+                    max_retries=0,
+                )
+                failed = res.status_code == 429 or res.status_code >= 500
+            except (requests.RequestException, http_client.CircuitOpenError) as exc:
+                res, failed = exc, True
+
+            if failed:
+                recoveries += 1
+                if recoveries > MAX_UPLOAD_RECOVERIES:
+                    raise RuntimeError(f"分割アップロードに失敗（再試行上限）: {local_path}: {res}")
+                time.sleep(http_client.backoff_delay(recoveries))
+                committed = _query_upload_offset(session_url, total)
+                if committed is None:
+                    os.remove(state_path)
+                    raise RuntimeError(f"アップロードセッションが失効しました。再実行してください: {local_path}")
+            elif res.status_code == 308:
+                committed = _committed_offset(res)
+            elif res.status_code in (200, 201):
+                committed = total
+            else:
+                raise RuntimeError(f"分割アップロードに失敗: {res.status_code} {res.text}")
+
+            # 上限は「進捗のない連続失敗」に対して適用する
+            if committed > offset:
+                recoveries = 0
+            offset = committed
+
+    os.remove(state_path)
+    return f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{dest_path}"
+
+
+def is_video(path_or_url):
+    return os.path.splitext(path_or_url.split("?", 1)[0])[1].lower() in VIDEO_EXTENSIONS
+
+
+def _upload_one(local_path, dest_path):
+    if is_video(local_path) or os.path.getsize(local_path) > RESUMABLE_THRESHOLD:
+        return upload_to_gcs_resumable(local_path, dest_path)
+    return upload_to_gcs(local_path, dest_path)
+
+
+def _object_name(local_path):
+    """
+    内容ハッシュ付きのオブジェクト名。ワーカーで並行する別ジョブの同名ファイル
+    （.../photo.jpg など）が同じ blob を上書きしないようにする。
+    同じ内容なら同じ名前になるので、再開可能アップロードの再開もそのまま効く。
+    """
+    digest = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return f"instagram/{digest.hexdigest()[:32]}/{os.path.basename(local_path)}"
+
+
+def upload_images(image_paths, max_workers=4):
+    """
+    画像・動画リストを並列に GCS へアップロードし、入力順の公開URLリストを返す。
+    大きなファイル・動画は再開可能な分割アップロードを使う。
+    """
+    dests = [_object_name(p) for p in image_paths]
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(_upload_one, image_paths, dests))
+
+
 
 
 # ========================================
 #  Instagram 子メディア
 # ========================================
-def create_child_media(image_url):
-    url = f"https://graph.facebook.com/v24.0/{IG_USER_ID}/media"
-    
+def create_child_media(image_url, account=None):
+    account = get_account(account)
+
     params = {
         "image_url": image_url,
         "is_carousel_item": True,
-        "access_token": ACCESS_TOKEN
     }
 
-    res = requests.post(url, params=params).json()
+    # 未公開コンテナは再作成しても害がないため冪等扱いでリトライ
+    res = account.graph_post("media", params).json()
     return res.get("id")
 
 
+def create_child_video(video_url, account=None):
+    """カルーセル用の動画子メディア（処理完了は wait_for_containers で待つ）"""
+    account = get_account(account)
+
+    params = {
+        "video_url": video_url,
+        "media_type": "VIDEO",
+        "is_carousel_item": True,
+    }
+
+    res = account.graph_post("media", params).json()
+    return res.get("id")
+
+
+# ========================================
+#  コンテナの処理状況ポーリング
+# ========================================
+def wait_for_containers(container_ids, account=None, timeout=CONTAINER_TIMEOUT, poll_interval=CONTAINER_POLL_INTERVAL):
+    """
+    コンテナの status_code がすべて FINISHED になるまで待つ。
+    動画の処理は数分かかることがあるが、待つのは呼び出し元スレッドのみ
+    （複数投稿・複数アカウントはそれぞれ別スレッドで並行して進む）。
+
+    未完了のコンテナは ?ids= でまとめて 1 回の呼び出しで確認し、間隔は
+    CONTAINER_POLL_MAX_INTERVAL まで伸ばしていく（アカウントの 1 時間あたりの
+    API 予算をポーリングで使い切らないため）。
+    """
+    account = get_account(account)
+    pending = set(container_ids)
+    deadline = time.monotonic() + timeout
+    interval = poll_interval
+
+    while pending:
+        # レート制限の待ちも含めて deadline を超えないようにする
+        response = account.graph_get_many(sorted(pending), {"fields": "status_code,status"}, deadline=deadline)
+        res = response.json()
+        if not response.ok or "error" in res:
+            raise RuntimeError(f"メディア状態の取得に失敗 ({sorted(pending)}): {res}")
+
+        for cid in list(pending):
+            item = res.get(cid) or {}
+            status = item.get("status_code")
+            if status in ("FINISHED", "PUBLISHED"):
+                pending.discard(cid)
+            elif status in ("ERROR", "EXPIRED"):
+                raise RuntimeError(f"メディア処理に失敗 ({cid}): {item}")
+
+        if not pending:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"メディア処理がタイムアウトしました: {sorted(pending)}")
+        time.sleep(min(interval, remaining))
+        interval = min(interval * CONTAINER_POLL_BACKOFF, CONTAINER_POLL_MAX_INTERVAL)
+
+
 # ========================================
 #  親カルーセル → publish
 # ========================================
-def publish_carousel(child_ids, caption):
+def publish_carousel(child_ids, caption, account=None):
     """子メディアをまとめてカルーセル投稿"""
-    url = f"https://graph.facebook.com/v24.0/{IG_USER_ID}/media"
+    account = get_account(account)
 
     params = {
         "caption": caption,
         "children": ",".join(child_ids),
         "media_type": "CAROUSEL",
-        "access_token": ACCESS_TOKEN
     }
 
-    res = requests.post(url, params=params).json()
+    res = account.graph_post("media", params).json()
     parent_id = res.get("id")
 
     if not parent_id:
         raise RuntimeError(f"親メディア作成に失敗: {res}")
 
-    # Instagram API の仕様で少し待つ
-    time.sleep(2)
+    # 親コンテナの処理完了を待つ（画像のみなら数秒、動画を含むと数分）
+    wait_for_containers([parent_id], account, poll_interval=2)
 
-    publish_url = f"https://graph.facebook.com/v24.0/{IG_USER_ID}/media_publish"
-    publish_res = requests.post(
-        publish_url,
-        params={"creation_id": parent_id, "access_token": ACCESS_TOKEN}
+    # publish は二重投稿を避けるため非冪等扱い（送信前の失敗・429 のみリトライ）
+    publish_res = account.graph_post(
+        "media_publish",
+        {"creation_id": parent_id},
+        idempotent=False,
     ).json()
 
     if "id" not in publish_res:
@@ -108,35 +337,119 @@ def publish_carousel(child_ids, caption):
     return publish_res
 
 
-# ========================================
-#  外部呼び出し用：まとめて投稿
-# ========================================
-def post_to_instagram(image_paths, caption):
+def post_carousel_urls(image_urls, caption, account=None):
     """
-    画像リストとキャプションを渡すと、Instagram にカルーセル投稿する関数
-    image_paths = ["img/a.png", "img/b.jpg", ...]
+    アップロード済みの画像・動画URLから子メディアを作成し、カルーセル公開する。
+    動画の子メディアは全件作成後にまとめて処理完了を待つ。
     """
-
-    # ---------- GCS にアップロード ----------
-    signed_urls = []
-    for p in image_paths:
-        dest = f"instagram/{os.path.basename(p)}"
-        url = upload_to_gcs(p, dest)
-        signed_urls.append(url)
-
-    # ---------- 子メディア作成 ----------
     child_ids = []
-    for url in signed_urls:
-        cid = create_child_media(url)
+    video_ids = []
+    for url in image_urls:
+        if is_video(url):
+            cid = create_child_video(url, account)
+            if cid:
+                video_ids.append(cid)
+        else:
+            cid = create_child_media(url, account)
         if cid:
             child_ids.append(cid)
 
     if not child_ids:
         raise RuntimeError("子メディアが1件も作成できませんでした。")
 
-    # ---------- カルーセル公開 ----------
-    result = publish_carousel(child_ids, caption)
-    return result
+    if video_ids:
+        wait_for_containers(video_ids, account)
 
+    return publish_carousel(child_ids, caption, account)
 
 
+# ========================================
+#  リール投稿
+# ========================================
+def publish_reel(video_url, caption, account=None, share_to_feed=True):
+    """動画URLからリールのコンテナを作成し、処理完了を待って公開する"""
+    account = get_account(account)
+
+    params = {
+        "video_url": video_url,
+        "media_type": "REELS",
+        "caption": caption,
+        "share_to_feed": share_to_feed,
+    }
+
+    res = account.graph_post("media", params).json()
+    container_id = res.get("id")
+    if not container_id:
+        raise RuntimeError(f"リールのコンテナ作成に失敗: {res}")
+
+    wait_for_containers([container_id], account)
+
+    publish_res = account.graph_post(
+        "media_publish",
+        {"creation_id": container_id},
+        idempotent=False,
+    ).json()
+
+    if "id" not in publish_res:
+        raise RuntimeError(f"公開に失敗: {publish_res}")
+
+    return publish_res
+
+
+def post_reel_to_instagram(video_path, caption, account=None, share_to_feed=True):
+    """ローカル動画を分割アップロードしてリール投稿する"""
+    video_url = upload_to_gcs_resumable(video_path, f"instagram/{os.path.basename(video_path)}")
+    return publish_reel(video_url, caption, account, share_to_feed)
+
+
+# ========================================
+#  外部呼び出し用：まとめて投稿
+# ========================================
+def post_to_instagram(image_paths, caption, account=None):
+    """
+    画像リストとキャプションを渡すと、Instagram にカルーセル投稿する関数
+    image_paths = ["img/a.png", "img/b.jpg", "video/c.mp4", ...]（動画も混在可）
+    account を省略すると IG_USER_ID / IG_ACCESS_TOKEN の default アカウントに投稿する。
+    """
+
+    # ---------- GCS にアップロード ----------
+    signed_urls = upload_images(image_paths)
+
+    # ---------- 子メディア作成 → カルーセル公開 ----------
+    return post_carousel_urls(signed_urls, caption, account)
+
+
+# ========================================
+#  複数アカウントへ同時投稿
+# ========================================
+def post_to_instagram_accounts(image_paths, caption, account_names=None, max_workers=None):
+    """
+    同じ画像を複数アカウントへカルーセル投稿する。
+    - GCS へのアップロードは 1 回だけ
+    - アカウントごとに独自のセッション・トークン・レート制限で並列に投稿
+    - caption は全アカウント共通の str か、{account_name: caption} の dict
+
+    戻り値: {account_name: {"ok": True, "result": ...} | {"ok": False, "error": "..."}}
+    """
+    accounts = registry.get_many(account_names)
+    if not accounts:
+        raise RuntimeError("投稿先アカウントが登録されていません。")
+
+    # ---------- GCS にアップロード（1回のみ） ----------
+    signed_urls = upload_images(image_paths)
+
+    def _post_one(account):
+        account_caption = caption[account.name] if isinstance(caption, dict) else caption
+        return post_carousel_urls(signed_urls, account_caption, account)
+
+    # ---------- アカウントごとに並列投稿 ----------
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(accounts)) as ex:
+        futures = {account.name: ex.submit(_post_one, account) for account in accounts}
+        for name, future in futures.items():
+            try:
+                results[name] = {"ok": True, "result": future.result()}
+            except Exception as exc:
+                results[name] = {"ok": False, "error": f"{type(exc).__name__}: {exc}"}
+
+    return results
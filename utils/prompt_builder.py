@@ -0,0 +1,49 @@
+"""
+Prompt assembly for provider-side prompt caching.
+
+OpenAI のプロンプトキャッシュは「先頭からのバイト一致」でヒットするため、
+- 静的な内容（指示文・テンプレート・writing_style）を必ず先頭に置く
+- JSON は sort_keys 付きの正規化シリアライズでバイト列を固定する
+- 可変の user payload は最後のメッセージにだけ入れる
+を保証する。
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+Section = Tuple[str, Any]
+
+
+def canonical_json(data: Any) -> str:
+    """
+    Byte-stable JSON serialization (key order / whitespace fixed).
+    """
+    return json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def build_system_prompt(base_prompt: str, sections: Sequence[Section] = ()) -> str:
+    """
+    Static instructions first, then each (heading, content) section.
+    content が str 以外なら canonical_json でシリアライズする。
+    """
+    parts = [base_prompt.strip()]
+    for heading, content in sections:
+        body = content if isinstance(content, str) else canonical_json(content)
+        parts.append(f"### {heading}\n{body}")
+    return "\n\n".join(parts) + "\n"
+
+
+def sorted_categories(categories: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Order template categories by name so the prefix doesn't depend on file order.
+    """
+    return sorted(categories, key=lambda c: str(c.get("name", "")))
+
+
+def prompt_cache_key(stage: str, system_prompt: str) -> str:
+    """
+    Routing hint for the provider cache: same stage + same static prefix → same key.
+    """
+    digest = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+    return f"{stage}:{digest}"
@@ -0,0 +1,372 @@
+"""
+Deep retrieval stage for Web RAG.
+
+Serper の snippet だけでなく、検索結果の link 先ページを取得して本文を抽出し、
+パッセージに分割したうえで BM25 でクエリとの関連度をローカルにランキングする。
+上位 top_k 件かつ token_budget 以内のパッセージのみを返すので、
+Caption Writer に渡るトークン数は上限付きで予測可能になる。
+"""
+
+import codecs
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Any, Dict, List, Optional, Sequence
+
+import requests
+
+from utils import http_client
+
+PAGE_FETCH_TIMEOUT = (3.05, 10.0)
+PAGE_MAX_BYTES = 1_000_000
+PAGE_FETCH_WORKERS = 8
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 6 * 60 * 60
+FAILED_FETCH_TTL = 5 * 60
+
+PASSAGE_TOKENS = 120
+DEFAULT_TOP_K = 3
+DEFAULT_TOKEN_BUDGET = 1200
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+_WORD_RE = re.compile(r"[0-9a-z]+|[぀-ヿ㐀-䶿一-鿿가-힯]+")
+_HEADER_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_META_CHARSET_RE = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。！？.!?])\s+|(?<=[。！？])|\n+")
+
+# 取得先ホストは検索結果次第で際限なく増えるので、ホスト単位のセッション・
+# ブレーカーは作らず 1 つのセッションを共有する（ホストごとのプールは
+# HTTPAdapter の pool_connections 件までの LRU で上限がある）。
+# 失敗した URL は failed_fetches で短時間スキップする。
+_page_session = http_client.new_session(pool_maxsize=PAGE_FETCH_WORKERS)
+
+
+# -------------------------------------------------
+# Tokenize / token estimate
+# -------------------------------------------------
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased word tokens for ranking / similarity.
+    英数字は単語単位、日本語など空白のない文字列は文字 bigram に分割する。
+    """
+    tokens: List[str] = []
+    for chunk in _WORD_RE.findall(text.lower()):
+        if _CJK_RE.match(chunk):
+            if len(chunk) == 1:
+                tokens.append(chunk)
+            else:
+                tokens.extend(chunk[i:i + 2] for i in range(len(chunk) - 1))
+        else:
+            tokens.append(chunk)
+    return tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough LLM token estimate without a tokenizer dependency.
+    CJK は 1 文字 ≒ 1 token、それ以外は 4 文字 ≒ 1 token として概算する。
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+# -------------------------------------------------
+# HTML → text（ストリーミング）
+# -------------------------------------------------
+class _TextExtractor(HTMLParser):
+    """Incremental HTML-to-text extractor that drops non-content elements."""
+
+    SKIP_TAGS = {"script", "style", "noscript", "svg", "head", "nav", "footer", "header", "form", "iframe"}
+    BLOCK_TAGS = {"p", "div", "br", "li", "section", "article", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "td", "blockquote"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip_depth = 0
+        self._parts: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth > 0:
+            self._skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if self._skip_depth == 0:
+            self._parts.append(data)
+
+    def text(self) -> str:
+        raw = "".join(self._parts)
+        lines = (re.sub(r"[ \t\r\f\v]+", " ", line).strip() for line in raw.split("\n"))
+        return "\n".join(line for line in lines if line)
+
+
+def _valid_codec(name: Optional[str]) -> Optional[str]:
+    if not name:
+        return None
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def _detect_encoding(content_type: str, head: bytes) -> str:
+    """
+    Content-Type の charset → <meta charset> → utf-8 の順で決める。
+    requests は charset なしの text/html を ISO-8859-1 とみなすが、
+    meta でのみ宣言する日本語ページが文字化けするためその既定値は使わない。
+    未知の charset 名は無視する。
+    """
+    match = _HEADER_CHARSET_RE.search(content_type)
+    codec = _valid_codec(match.group(1)) if match else None
+    if codec:
+        return codec
+
+    match = _META_CHARSET_RE.search(head)
+    codec = _valid_codec(match.group(1).decode("ascii", "ignore")) if match else None
+    return codec or "utf-8"
+
+
+def fetch_page_text(url: str, *, max_bytes: int = PAGE_MAX_BYTES) -> str:
+    """
+    Fetch a page and extract its text, streaming at most max_bytes.
+    HTML / plain text 以外のコンテンツは空文字を返す。
+    """
+    response = http_client.get(
+        url,
+        stream=True,
+        timeout=PAGE_FETCH_TIMEOUT,
+        max_retries=1,
+        session=_page_session,
+        use_breaker=False,
+    )
+    try:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "").lower()
+        if content_type and "html" not in content_type and "text/plain" not in content_type:
+            return ""
+
+        if "html" in content_type or not content_type:
+            parser = _TextExtractor()
+            feed = parser.feed
+        else:
+            parser = None
+            plain: List[str] = []
+            feed = plain.append
+
+        chunks = response.iter_content(chunk_size=16 * 1024)
+        head = next(chunks, b"")
+        decoder = codecs.getincrementaldecoder(_detect_encoding(content_type, head))(errors="replace")
+
+        received = len(head)
+        feed(decoder.decode(head))
+        if received < max_bytes:
+            for chunk in chunks:
+                received += len(chunk)
+                feed(decoder.decode(chunk))
+                if received >= max_bytes:
+                    break
+        feed(decoder.decode(b"", final=True))
+
+        if parser is not None:
+            parser.close()
+            return parser.text()
+        return "".join(plain)
+    finally:
+        response.close()
+
+
+# -------------------------------------------------
+# Page cache
+# -------------------------------------------------
+class PageCache:
+    """Thread-safe LRU cache with a TTL (page text; also reused for Serper results)."""
+
+    def __init__(self, max_entries: int = PAGE_CACHE_SIZE, ttl: float = PAGE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+page_cache = PageCache()
+# 失敗した URL は短時間だけ記録し、同じ投稿内で再取得（タイムアウト待ち）しない
+failed_fetches = PageCache(ttl=FAILED_FETCH_TTL)
+_fetch_executor = ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS, thread_name_prefix="rag-fetch")
+
+
+def _fetch_cached(url: str) -> str:
+    cached = page_cache.get(url)
+    if cached is not None:
+        return cached
+    if failed_fetches.get(url):
+        return ""
+    try:
+        text = fetch_page_text(url)
+    except (requests.RequestException, http_client.CircuitOpenError, LookupError, ValueError) as exc:
+        print(f"WARN: page fetch failed for {url}: {exc}")
+        failed_fetches.set(url, True)
+        return ""
+    page_cache.set(url, text)
+    return text
+
+
+def fetch_pages(urls: Sequence[str]) -> Dict[str, str]:
+    """
+    Fetch several pages concurrently (deduplicated, cache-aware).
+    Returns {url: text}. 取得に失敗したページは空文字。
+    """
+    unique = [u for u in dict.fromkeys(urls) if u]
+    return dict(zip(unique, _fetch_executor.map(_fetch_cached, unique)))
+
+
+# -------------------------------------------------
+# Passage split
+# -------------------------------------------------
+def split_passages(text: str, *, passage_tokens: int = PASSAGE_TOKENS) -> List[str]:
+    """
+    Split page text into passages of roughly passage_tokens each, on sentence boundaries.
+    """
+    passages: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+
+    for sentence in _SENTENCE_SPLIT_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        n = estimate_tokens(sentence)
+        if current and current_tokens + n > passage_tokens:
+            passages.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += n
+
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+# -------------------------------------------------
+# BM25
+# -------------------------------------------------
+class BM25:
+    """Okapi BM25 over a small in-memory corpus of token lists."""
+
+    def __init__(self, corpus: Sequence[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(doc) for doc in corpus]
+        self.doc_lens = [len(doc) for doc in corpus]
+        self.avgdl = (sum(self.doc_lens) / len(corpus)) if corpus else 0.0
+
+        doc_freq: Counter = Counter()
+        for tf in self.term_freqs:
+            doc_freq.update(tf.keys())
+        n = len(corpus)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def score(self, query_tokens: Sequence[str], index: int) -> float:
+        tf = self.term_freqs[index]
+        dl = self.doc_lens[index]
+        total = 0.0
+        for term in query_tokens:
+            freq = tf.get(term)
+            if not freq:
+                continue
+            norm = freq + self.k1 * (1 - self.b + self.b * dl / (self.avgdl or 1))
+            total += self.idf.get(term, 0.0) * freq * (self.k1 + 1) / norm
+        return total
+
+
+def rank_passages(
+    query: str,
+    passages: Sequence[Dict[str, Any]],
+    *,
+    top_k: int = DEFAULT_TOP_K,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+) -> List[Dict[str, Any]]:
+    """
+    Rank passages ({"text", "link", "title"}) against the query with BM25 and
+    keep at most top_k of them whose combined estimated tokens fit token_budget.
+    """
+    if not passages:
+        return []
+
+    bm25 = BM25([tokenize(p["text"]) for p in passages])
+    query_tokens = tokenize(query)
+    scored = sorted(
+        ((bm25.score(query_tokens, i), i) for i in range(len(passages))),
+        key=lambda x: x[0],
+        reverse=True,
+    )
+
+    selected: List[Dict[str, Any]] = []
+    used_tokens = 0
+    seen = set()
+    for score, i in scored:
+        if len(selected) >= top_k or score <= 0:
+            break
+        text = passages[i]["text"]
+        if text in seen:
+            continue
+        n = estimate_tokens(text)
+        if used_tokens + n > token_budget:
+            continue
+        seen.add(text)
+        used_tokens += n
+        selected.append({**passages[i], "score": round(score, 3)})
+    return selected
+
+
+def deep_retrieve(
+    query: str,
+    results: Sequence[Dict[str, str]],
+    *,
+    top_k: int = DEFAULT_TOP_K,
+    token_budget: int = DEFAULT_TOKEN_BUDGET,
+    pages: Optional[Dict[str, str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Fetch the result links of one query, split into passages and return the best ones.
+    results は web_rag_search の抽出結果（title / snippet / link）。
+    pages（fetch_pages の結果）を渡すと再取得しない。
+    """
+    if pages is None:
+        pages = fetch_pages([r.get("link", "") for r in results])
+
+    passages: List[Dict[str, Any]] = []
+    for r in results:
+        text = pages.get(r.get("link", ""), "")
+        for passage in split_passages(text):
+            passages.append({"text": passage, "link": r.get("link", ""), "title": r.get("title", "")})
+
+    return rank_passages(query, passages, top_k=top_k, token_budget=token_budget)
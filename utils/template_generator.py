@@ -2,7 +2,9 @@
 
 import json
 from typing import Dict, Any
+from utils import model_router
 from utils.llm import run_gpt_json
+from utils.prompt_builder import prompt_cache_key
 
 
 # -------------------------------------------------
@@ -86,6 +88,16 @@ REQUIRED_TEMPLATE_KEYS = [
     "example_caption",
 ]
 
+# run_gpt_json 側での検証・補修用（フィールド → 型）
+TEMPLATE_SCHEMA = {
+    "name": str,
+    "caption_structure": list,
+    "writing_style": dict,
+    "hashtag_pattern": list,
+    "example_structure": list,
+    "example_caption": str,
+}
+
 
 def _validate_template_dict(data: Dict[str, Any]):
     """
@@ -121,10 +133,14 @@ def generate_template_from_post(caption_text: str) -> Dict[str, Any]:
     GPTはSTRICT JSONで返すように制御している。
     """
 
-    result = run_gpt_json(
+    result = model_router.run_stage(
+        "template_generator",
+        run_gpt_json,
         prompt=caption_text,
         history=[{"role": "system", "content": TEMPLATE_EXTRACTION_PROMPT}],
-        max_completion_tokens=2048,
+        prompt_cache_key=prompt_cache_key("template_generator", TEMPLATE_EXTRACTION_PROMPT),
+        schema=TEMPLATE_SCHEMA,
+        stage="template_generator",
     )
 
     # Validate structure
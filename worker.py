@@ -0,0 +1,222 @@
+"""
+常駐ワーカーサービス（ローカル HTTP サーバー）
+
+ノートブックや cron から毎回起動すると、import・OpenAI / GCS クライアント生成・
+テンプレート JSON 読み込みが毎投稿ごとに発生する。このサービスはそれらを
+起動時に一度だけ行い、接続プール・キャッシュを温めたままジョブを並行処理する。
+
+起動:
+    python worker.py --host 127.0.0.1 --port 8765 --workers 4
+
+エンドポイント:
+    GET  /health          稼働状態
+    GET  /queue           待機中・実行中・完了済みジョブ数
+    POST /jobs/caption    {"user_input": {...}, "deep_rag": false}
+    POST /jobs/post       {"user_input": {...}, "image_paths": [...], "account_names": [...]}
+    GET  /jobs/<job_id>   ジョブの状態と結果
+
+SIGINT / SIGTERM を受けると新規ジョブを 503 で拒否し、実行中・待機中のジョブを
+処理し終えてから終了する。
+"""
+
+import argparse
+import json
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+
+from main import auto_post_instagram
+from utils.caption_agent import generate_instagram_caption
+
+DEFAULT_TEMPLATES_PATH = "utils/template_example.json"
+MAX_FINISHED_JOBS = 1000
+
+
+def load_templates(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ========================================
+#  ジョブ実行
+# ========================================
+class JobRunner:
+    """
+    Thread pool + job table. 完了済みジョブは MAX_FINISHED_JOBS 件まで保持する。
+    """
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="post-worker")
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._accepting = True
+
+    @property
+    def accepting(self) -> bool:
+        return self._accepting
+
+    def submit(self, kind: str, fn: Callable[[], Any]) -> Optional[str]:
+        with self._lock:
+            if not self._accepting:
+                return None
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"id": job_id, "kind": kind, "status": "queued", "submitted_at": time.time()}
+            self._executor.submit(self._run, job_id, fn)
+            return job_id
+
+    def _run(self, job_id: str, fn: Callable[[], Any]):
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            result = fn()
+        except Exception as exc:
+            self._update(job_id, status="failed", error=f"{type(exc).__name__}: {exc}", finished_at=time.time())
+        else:
+            self._update(job_id, status="done", result=result, finished_at=time.time())
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+            if fields.get("status") in ("done", "failed"):
+                self._evict_finished()
+
+    def _evict_finished(self):
+        finished = [jid for jid, job in self._jobs.items() if job["status"] in ("done", "failed")]
+        for jid in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[jid]
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for job in self._jobs.values():
+                counts[job["status"]] += 1
+        counts["accepting"] = self._accepting
+        return counts
+
+    def drain(self):
+        """新規受付を止め、待機中・実行中のジョブがすべて終わるまで待つ"""
+        with self._lock:
+            self._accepting = False
+        self._executor.shutdown(wait=True)
+
+
+# ========================================
+#  HTTP ハンドラ
+# ========================================
+def make_handler(runner: JobRunner, templates_json: Dict[str, Any]):
+
+    def caption_job(body: Dict[str, Any]) -> Callable[[], Any]:
+        user_input = body["user_input"]
+        templates = body.get("templates") or templates_json
+        deep_rag = bool(body.get("deep_rag", False))
+        return lambda: generate_instagram_caption(user_input, templates, deep_rag=deep_rag)
+
+    def post_job(body: Dict[str, Any]) -> Callable[[], Any]:
+        user_input = body["user_input"]
+        image_paths = body["image_paths"]
+        account_names = body.get("account_names")
+        templates = body.get("templates") or templates_json
+        deep_rag = bool(body.get("deep_rag", False))
+
+        return lambda: auto_post_instagram(
+            user_input, image_paths, templates, deep_rag=deep_rag, account_names=account_names
+        )
+
+    job_factories = {
+        "/jobs/caption": ("caption", caption_job),
+        "/jobs/post": ("post", post_job),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status: int, payload: Any):
+            body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200 if runner.accepting else 503, {"status": "ok" if runner.accepting else "draining"})
+            elif self.path == "/queue":
+                self._send_json(200, runner.stats())
+            elif self.path.startswith("/jobs/"):
+                job = runner.get(self.path[len("/jobs/"):])
+                if job is None:
+                    self._send_json(404, {"error": "job not found"})
+                else:
+                    self._send_json(200, job)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path not in job_factories:
+                self._send_json(404, {"error": "not found"})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                kind, factory = job_factories[self.path]
+                fn = factory(body)
+            except (ValueError, KeyError, TypeError) as exc:
+                self._send_json(400, {"error": f"invalid request: {exc}"})
+                return
+
+            job_id = runner.submit(kind, fn)
+            if job_id is None:
+                self._send_json(503, {"error": "worker is shutting down"})
+                return
+            self._send_json(202, {"job_id": job_id})
+
+        def log_message(self, format, *args):
+            print(f"[worker] {self.address_string()} - {format % args}")
+
+    return Handler
+
+
+def serve(host: str, port: int, workers: int, templates_path: str):
+    templates_json = load_templates(templates_path)
+    runner = JobRunner(workers)
+    server = ThreadingHTTPServer((host, port), make_handler(runner, templates_json))
+    server.daemon_threads = True
+
+    def _shutdown(signum, frame):
+        print(f"[worker] signal {signum} received: draining jobs...")
+
+        def _drain_and_stop():
+            runner.drain()
+            server.shutdown()
+
+        threading.Thread(target=_drain_and_stop, daemon=True).start()
+
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    print(f"[worker] listening on http://{host}:{port} (workers={workers})")
+    server.serve_forever()
+    server.server_close()
+    print("[worker] stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Instagram auto-post warm worker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--templates", default=DEFAULT_TEMPLATES_PATH)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.templates)